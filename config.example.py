@@ -17,6 +17,7 @@ CONFIG = {
     # Telegram 配置
     'telegram_token': 'botxxxxx:xxxxxx',  # Telegram Bot Token
     'telegram_chat_id': '123456789',  # Telegram 聊天 ID
+    'telegram_batch_window': 1,  # 该时间窗口（秒）内的多条错误通知合并为一条发送
 
     # AI 服务配置（四选一：azure, openai, deepseek, gemini）
     'ai_provider': 'gemini',  # 可选: 'azure', 'openai', 'deepseek', 'gemini'
@@ -47,6 +48,13 @@ CONFIG = {
 
     # AI 错误处理配置
     'openai_max_retries': 3,  # AI 调用最大重试次数
+    'ai_max_prompt_tokens': 3000,  # 每个剪藏发送给 AI 的正文最大 token 数
+    'ai_batch_size': 5,  # 短时间内多个剪藏合并为一次 AI 调用的最大数量
+    'ai_batch_window': 0.5,  # 合并等待窗口（秒）
+    'ai_max_batch_tokens': 6000,  # 合并调用中所有正文的 token 总数上限（按模型上下文设置）
+    'ai_timeout': 300,  # 单个剪藏等待 AI 摘要的最长时间（秒），超时按 AI 失败处理
+    'openai_rpm': 500,  # AI 服务每分钟最大请求数（按服务商限额设置，主动限速避免 429）
+    'openai_max_concurrency': 5,  # 同时进行的 AI 请求数上限
     'default_summary': '这是一个网页存档',  # AI 失效时的默认摘要
     'default_tags': ['未分类'],  # AI 失效时的默认标签
     'skip_ai_on_error': True,  # AI 失效时是否继续保存
@@ -1,10 +1,11 @@
 import os
 import time
-import requests
+import httpx
 from github import Github
 import openai
-from notion_client import Client
+from notion_client import AsyncClient
 import telegram
+from telegram.request import HTTPXRequest
 import logging
 from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Header, Request, Body
 import uvicorn
@@ -17,10 +18,14 @@ from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from config import CONFIG  # 添加这行在文件开头
 from bs4 import BeautifulSoup  # 添加到导入部分
-import html2text
 from contextlib import asynccontextmanager
+from collections import OrderedDict
 import asyncio
+import aiofiles
 import google.generativeai as genai
+import tiktoken
+from aiolimiter import AsyncLimiter
+import re
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -32,10 +37,62 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 # 定义全局变量
 handler = None
 UPLOAD_DIR = Path("uploads")
+PENDING_FILES = OrderedDict()  # 临时文件 -> 写入时间，按写入顺序排列
+FILE_MAX_AGE = 3600  # 临时文件最长保留时间（秒）
 
 # 配置限制
 MAX_FILE_SIZE = CONFIG.get('max_file_size', 10 * 1024 * 1024)  # 从配置中获取最大文件大小
 ALLOWED_EXTENSIONS = set(CONFIG.get('allowed_extensions', ['.html', '.htm']))
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096  # Telegram 单条消息最大长度
+UPLOAD_CHUNK_SIZE = 1 << 20  # 上传文件分块写入大小（1MB）
+FILE_FIELD_NAMES = ('file', 'singlehtmlfile')  # 文件字段名：curl 示例 / SingleFile 插件
+FORM_OVERHEAD = 64 * 1024  # multipart 表单中除文件外的额外开销（边界、url 字段等）
+
+# AI 提示词
+SUMMARY_PROMPT = """请为以下网页内容生成简短摘要和相关标签。
+
+要求：
+1. 无论原文是中文还是英文，都必须用中文回复
+2. 摘要控制在100字以内
+3. 生成3-5个中文标签
+4. 严格按照以下格式返回：
+
+摘要：[100字以内的中文摘要]
+标签：tag1，tag2，tag3，tag4，tag5
+
+网页内容：
+"""
+
+BATCH_SUMMARY_PROMPT = """请为以下 {count} 个网页内容分别生成简短摘要和相关标签。
+
+要求：
+1. 无论原文是中文还是英文，都必须用中文回复
+2. 每个摘要控制在100字以内
+3. 每个网页生成3-5个中文标签
+4. 按文档顺序逐个返回，严格按照以下格式：
+
+=== 文档1 ===
+摘要：[100字以内的中文摘要]
+标签：tag1，tag2，tag3，tag4，tag5
+=== 文档2 ===
+摘要：[100字以内的中文摘要]
+标签：tag1，tag2，tag3，tag4，tag5
+
+网页内容：
+"""
+
+# 批量结果中每个文档的分隔行，例如 "=== 文档1 ==="，
+# 也兼容模型加上的 markdown 修饰，如 "**=== 文档1 ===**"、"### 文档1"
+BATCH_SECTION_RE = re.compile(r'^[ \t>*#=_-]*文档[ \t]*(\d+)[ \t*#=_:：-]*$', re.M)
+
+# AI 返回结果中的摘要行和标签行（两行顺序不限）
+SUMMARY_RE = re.compile(r'^摘要：(.*)$', re.M)
+TAGS_RE = re.compile(r'^标签：(.*)$', re.M)
+
+# jina.ai 返回内容开头的标题行，例如 "Title: xxx"
+TITLE_RE = re.compile(r'^Title:[ \t]*(.*)$', re.M)
+TITLE_SEARCH_LIMIT = 4096  # 标题总在开头，只在前 4KB 中查找
+
 API_KEY_NAME = "X-API-Key"
 api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=True)
 
@@ -103,8 +160,36 @@ class WebClipperHandler:
     def __init__(self, config):
         self.config = config
         self.github_client = Github(config['github_token'])
-        self.notion_client = Client(auth=config['notion_token'])
-        self.telegram_bot = telegram.Bot(token=config['telegram_token'])
+        self._repo = None  # 首次上传时获取并缓存
+        self._pages_prefix = (
+            f"https://{config['github_pages_domain']}/"
+            f"{config['github_repo'].split('/')[1]}/clips/"
+        )
+        self.notion_client = AsyncClient(auth=config['notion_token'])
+        # 使用固定连接池，连续通知复用同一个连接
+        self.telegram_bot = telegram.Bot(
+            token=config['telegram_token'],
+            request=HTTPXRequest(connection_pool_size=8, pool_timeout=5)
+        )
+        self._notify_buffer = []  # 等待合并发送的错误通知及其 future
+        self._notify_task = None
+        # 共享连接池，重试和并发请求复用 keep-alive 连接，省去重复 TLS 握手
+        self.http_client = httpx.AsyncClient(
+            timeout=10,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=10)
+        )
+        
+        self._tok = None  # 提示词截断用的 tokenizer，由 lifespan 调用 init_tokenizer 加载
+        self.summary_queue = asyncio.Queue()  # 待合并处理的摘要请求
+        self.summary_task = None  # 后台摘要合并任务，由 lifespan 启动
+        self._batch_tasks = set()  # 正在执行的批量摘要任务，保留引用防止被回收
+        
+        # AI 调用限流：按服务商 RPM 主动限速，并限制同时进行的请求数
+        self._rate_limiter = AsyncLimiter(
+            max_rate=config.get('openai_rpm', 500), time_period=60
+        )
+        self._ai_semaphore = asyncio.Semaphore(config.get('openai_max_concurrency', 5))
         
         # 配置 AI 服务
         self.ai_provider = config.get('ai_provider', 'openai').lower()
@@ -145,11 +230,14 @@ class WebClipperHandler:
             logger.info("🔄 开始处理新的网页剪藏...")
             
             # 1. 上传到 GitHub Pages
-            filename, github_url = self.upload_to_github(str(file_path))
+            async with aiofiles.open(file_path, 'rb') as f:
+                content = await f.read()
+            filename, github_url = await self.upload_to_github(content, file_path.name)
+            del content  # 后续步骤不再需要文件内容，尽早释放内存
             logger.info(f"📤 GitHub 上传成功: {github_url}")
 
             # Github URL 转换为 Markdown
-            md_content = self.url2md(github_url)
+            md_content = await self.url2md(github_url)
             
             # 2. 获取页面标题
             title = self.get_page_content_by_md(md_content)
@@ -161,31 +249,30 @@ class WebClipperHandler:
                 original_url = file_info['original_url']
             
             # 3. 生成摘要和标签
-            summary, tags = self.generate_summary_tags(md_content)
+            summary, tags = await self.generate_summary_tags(md_content)
             logger.info(f"📝 摘要: {summary[:100]}...")
             logger.info(f"🏷️ 标签: {', '.join(tags)}")
             
-            # 4. 保存到 Notion
-            notion_url = self.save_to_notion({
-                'title': title,
-                'original_url': original_url,
-                'snapshot_url': github_url,
-                'summary': summary,
-                'tags': tags,
-                'created_at': time.time()
-            })
-            logger.info(f"📓 Notion 保存成功")
-            
-            # 5. 发送 Telegram 通知
+            # 4. 保存到 Notion，同时发送 Telegram 通知（两者互不依赖）
             notification = (
                 f"✨ 新的网页剪藏\n\n"
                 f"📑 {title}\n\n"
                 f"📝 {summary}\n\n"
                 f"🔗 原始链接：{original_url}\n"
-                f"📚 快照链接：{github_url}\n"
-                f"📚 Notion笔记: {notion_url}"
+                f"📚 快照链接：{github_url}"
             )
-            await self.send_telegram_notification(notification)
+            notion_url, _ = await asyncio.gather(
+                self.save_to_notion({
+                    'title': title,
+                    'original_url': original_url,
+                    'snapshot_url': github_url,
+                    'summary': summary,
+                    'tags': tags,
+                    'created_at': time.time()
+                }),
+                self.send_telegram_notification(notification)
+            )
+            logger.info(f"📓 Notion 保存成功")
             
             logger.info("=" * 50)
             logger.info("✨ 网页剪藏处理完成!")
@@ -204,32 +291,38 @@ class WebClipperHandler:
             error_msg = f"❌ 处理失败: {str(e)}"
             logger.error(error_msg)
             logger.error("=" * 50)
-            await self.send_telegram_notification(error_msg)
+            await self.send_error_notification(error_msg)
             raise
 
-    def upload_to_github(self, html_path):
-        """上传 HTML 文件到 GitHub Pages"""
-        filename = os.path.basename(html_path)
+    async def get_repo(self):
+        """获取 GitHub 仓库对象（只请求一次，之后复用）"""
+        if self._repo is None:
+            self._repo = await asyncio.to_thread(
+                self.github_client.get_repo, self.config['github_repo']
+            )
+        return self._repo
+
+    async def upload_to_github(self, content: bytes, filename: str):
+        """上传 HTML 内容到 GitHub Pages"""
         max_retries = 5
         retry_delay = 3  # 秒
         
-        with open(html_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
         for attempt in range(max_retries):
             try:
-                repo = self.github_client.get_repo(self.config['github_repo'])
+                repo = await self.get_repo()
                 file_path = f"clips/{filename}"
                 
                 # 直接创建新文件，因为文件名包含随机前缀，不可能重复
-                repo.create_file(
+                # PyGithub 是同步阻塞调用，放到线程池执行以免阻塞事件循环
+                await asyncio.to_thread(
+                    repo.create_file,
                     file_path,
                     f"Add web clip: {filename}",
                     content,
                     branch="main"
                 )
                 
-                github_url = f"https://{self.config['github_pages_domain']}/{self.config['github_repo'].split('/')[1]}/clips/{filename}"
+                github_url = self._pages_prefix + filename
                 logger.info(f"📑 文件已上传到 GitHub: {github_url}")
                 
                 # 等待 GitHub Pages 部署
@@ -240,16 +333,15 @@ class WebClipperHandler:
                 logger.info(f"⏳ 等待 GitHub Pages 部署 (最长等待 {total_wait_time} 秒)")
                 start_time = time.time()
                 
-                session = requests.Session()
                 consecutive_successes = 0  # 连续成功次数
                 required_successes = 2  # 需要连续成功的次数
                 
                 for deploy_attempt in range(max_deploy_retries):
                     try:
-                        response = session.get(
+                        # 只需要状态码，用 HEAD 避免下载整个页面
+                        response = await self.http_client.head(
                             github_url,
                             timeout=5,
-                            verify=True,
                             headers={
                                 'Cache-Control': 'no-cache',
                                 'Pragma': 'no-cache',
@@ -275,16 +367,16 @@ class WebClipperHandler:
                                 f"剩余最长等待时间: {remaining_time:.1f}秒"
                             )
                         
-                        time.sleep(deploy_retry_interval)
+                        await asyncio.sleep(deploy_retry_interval)
                         
-                    except requests.RequestException as e:
+                    except httpx.HTTPError as e:
                         consecutive_successes = 0
                         if deploy_attempt % 5 == 0:
                             logger.warning(
                                 f"部署检查失败 ({deploy_attempt + 1}/{max_deploy_retries}): "
                                 f"{e.__class__.__name__}: {str(e)}"
                             )
-                        time.sleep(deploy_retry_interval)
+                        await asyncio.sleep(deploy_retry_interval)
                 
                 logger.warning(
                     "⚠️ GitHub Pages 部署超时，但将继续处理。"
@@ -296,141 +388,319 @@ class WebClipperHandler:
                 error_msg = f"GitHub 上传尝试 {attempt + 1}/{max_retries} 失败: {e.__class__.__name__}: {str(e)}"
                 if attempt < max_retries - 1:
                     logger.warning(f"{error_msg} - 将在 {retry_delay} 秒后重试...")
-                    time.sleep(retry_delay)
+                    await asyncio.sleep(retry_delay)
                     retry_delay *= 2  # 指数退避
                     continue
                 else:
                     logger.error(f"❌ {error_msg}")
                     raise RuntimeError(f"GitHub 上传失败: {str(e)}") from e
 
-    def url2md(self, url, max_retries=30):
+    async def url2md(self, url, max_retries=30):
         """将 URL 转换为 Markdown"""
         try:
             for attempt in range(max_retries):
                 try:
                     md_url = f"https://r.jina.ai/{url}"
-                    response = requests.get(md_url)
+                    # jina.ai 需要渲染整个页面，大页面耗时较长，单独放宽读取超时
+                    response = await self.http_client.get(
+                        md_url, timeout=httpx.Timeout(10, read=120)
+                    )
                     if response.status_code == 200:
                         md_content = response.text
                         return md_content
                 except Exception:
-                    time.sleep(10)
+                    await asyncio.sleep(10)
         except Exception:
-            md_content = self.get_page_content_by_bs(url)
+            md_content = await self.get_page_content_by_bs(url)
             return md_content
 
-    def generate_summary_tags(self, content):
-        """使用 AI 生成摘要和标签"""
+    async def init_tokenizer(self, timeout=10):
+        """在线程中加载 tokenizer，超时则保持按字符截断，避免下载卡住启动"""
         try:
-            prompt = """请为以下网页内容生成简短摘要和相关标签。
+            self._tok = await asyncio.wait_for(asyncio.to_thread(self.load_tokenizer), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"加载 tiktoken 编码超过 {timeout} 秒，将按字符截断提示词")
 
-要求：
-1. 无论原文是中文还是英文，都必须用中文回复
-2. 摘要控制在100字以内
-3. 生成3-5个中文标签
-4. 严格按照以下格式返回：
+    def load_tokenizer(self):
+        """加载 tiktoken 编码，加载失败（如无法下载编码文件）时返回 None"""
+        try:
+            try:
+                return tiktoken.encoding_for_model(
+                    self.config.get('openai_model', 'gpt-3.5-turbo')
+                )
+            except KeyError:
+                # 非 OpenAI 模型没有对应编码，用通用编码近似估算
+                return tiktoken.get_encoding('cl100k_base')
+        except Exception as e:
+            logger.warning(f"加载 tiktoken 编码失败，将按字符截断提示词: {str(e)}")
+            return None
+
+    def truncate_content(self, content):
+        """去掉 jina.ai 的头部信息，并按 token 预算截断正文"""
+        # jina.ai 返回 Title/URL Source 等头部，正文在 "Markdown Content:" 之后
+        marker = content.find('Markdown Content:')
+        if marker >= 0:
+            content = content[marker + len('Markdown Content:'):]
+        elif content.startswith('Title:'):
+            # 兜底解析的格式为 "Title: xxx \n\n 正文"
+            content = content.split('\n\n', 1)[-1]
+        return self.truncate_tokens(content.strip())
+
+    def count_tokens(self, content):
+        """估算文本的 token 数，没有 tokenizer 时按字符数换算"""
+        if self._tok is None:
+            return len(content) * 3 // 5
+        return len(self._tok.encode(content))
+
+    def truncate_tokens(self, content, max_tokens=None):
+        """按 token 预算截断文本，默认预算为 ai_max_prompt_tokens"""
+        if max_tokens is None:
+            max_tokens = self.config.get('ai_max_prompt_tokens', 3000)
+        if self._tok is None:
+            # 没有 tokenizer 时按字符截断（默认 3000 token 对应原来的 5000 字符）
+            max_chars = max_tokens * 5 // 3
+            if len(content) <= max_chars:
+                return content
+            return content[:max_chars] + "..."
+        
+        # 一个 token 通常远少于 8 个字符，先按字符粗截断，避免对整篇长文编码
+        head = content[:max_tokens * 8]
+        tokens = self._tok.encode(head)
+        if len(tokens) <= max_tokens:
+            return content if len(head) == len(content) else head + "..."
+        return self._tok.decode(tokens[:max_tokens]) + "..."
+
+    def call_ai(self, prompt, max_output_tokens=1024):
+        """调用配置的 AI 服务，返回原始文本结果"""
+        if self.ai_provider == 'azure':
+            response = self.client.chat.completions.create(
+                model=self.config['azure_deployment_name'],
+                messages=[{"role": "user", "content": prompt}]
+            )
+            result = response.choices[0].message.content
+        elif self.ai_provider == 'deepseek':
+            response = self.client.chat.completions.create(
+                model=self.config.get('deepseek_model', 'deepseek-chat'),
+                messages=[{"role": "user", "content": prompt}]
+            )
+            result = response.choices[0].message.content
+        elif self.ai_provider == 'gemini':
+            # 修改 Gemini 调用方式
+            try:
+                response = self.client.generate_content(
+                    prompt,
+                    generation_config={
+                        "temperature": 0.7,
+                        "top_p": 0.8,
+                        "top_k": 40,
+                        "max_output_tokens": max_output_tokens,
+                    },
+                    safety_settings=[
+                        {
+                            "category": "HARM_CATEGORY_HARASSMENT",
+                            "threshold": "BLOCK_NONE",
+                        },
+                        {
+                            "category": "HARM_CATEGORY_HATE_SPEECH",
+                            "threshold": "BLOCK_NONE",
+                        },
+                        {
+                            "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+                            "threshold": "BLOCK_NONE",
+                        },
+                        {
+                            "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+                            "threshold": "BLOCK_NONE",
+                        },
+                    ]
+                )
+                
+                if response.prompt_feedback.block_reason:
+                    raise Exception(f"Content blocked: {response.prompt_feedback.block_reason}")
+                    
+                result = response.text
+                
+                # 如果返回为空，抛出异常
+                if not result.strip():
+                    raise Exception("Empty response from Gemini")
+                    
+            except Exception as e:
+                logger.error(f"Gemini API error: {str(e)}")
+                raise
+        else:
+            response = self.client.chat.completions.create(
+                model=self.config.get('openai_model', 'gpt-3.5-turbo'),
+                messages=[{"role": "user", "content": prompt}]
+            )
+            result = response.choices[0].message.content
 
-摘要：[100字以内的中文摘要]
-标签：tag1，tag2，tag3，tag4，tag5
+        logger.info(f"AI 生成结果: {result}")
+        return result
 
-网页内容：
-""" + content[:5000] + "..."
+    def parse_summary_tags(self, result):
+        """从 AI 返回结果中解析摘要和标签"""
+        summary_match = SUMMARY_RE.search(result)
+        tags_match = TAGS_RE.search(result)
+        if not summary_match or not tags_match:
+            raise ValueError("AI 响应格式不正确")
+        
+        summary = summary_match.group(1).strip()
+        tags = [tag.strip() for tag in tags_match.group(1).split('，') if tag.strip()]
+        
+        if not summary or not tags:
+            raise ValueError("AI 响应格式不正确")
+        
+        return summary, tags
 
-            max_retries = self.config.get('openai_max_retries', 3)
-            for attempt in range(max_retries):
+    def parse_batch_result(self, result, count):
+        """解析批量结果，返回与文档顺序一致的列表，解析失败的位置为 None"""
+        parts = BATCH_SECTION_RE.split(result)
+        sections = dict(zip(parts[1::2], parts[2::2]))
+        
+        results = []
+        for index in range(1, count + 1):
+            try:
+                results.append(self.parse_summary_tags(sections.get(str(index), '')))
+            except ValueError:
+                results.append(None)
+        return results
+
+    async def summary_worker(self):
+        """后台合并摘要请求：在时间窗口内收集多个请求，一次 AI 调用处理"""
+        batch_size = self.config.get('ai_batch_size', 5)
+        batch_window = self.config.get('ai_batch_window', 0.5)
+        max_batch_tokens = self.config.get('ai_max_batch_tokens', 6000)
+        loop = asyncio.get_running_loop()
+        carry = None  # 超出上一批总量限制、留给下一批的请求
+        
+        while True:
+            item = carry if carry is not None else await self.summary_queue.get()
+            carry = None
+            batch = [item]
+            total_tokens = self.count_tokens(item[0])
+            deadline = loop.time() + batch_window
+            while len(batch) < batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
                 try:
-                    if self.ai_provider == 'azure':
-                        response = self.client.chat.completions.create(
-                            model=self.config['azure_deployment_name'],
-                            messages=[{"role": "user", "content": prompt}]
-                        )
-                        result = response.choices[0].message.content
-                    elif self.ai_provider == 'deepseek':
-                        response = self.client.chat.completions.create(
-                            model=self.config.get('deepseek_model', 'deepseek-chat'),
-                            messages=[{"role": "user", "content": prompt}]
-                        )
-                        result = response.choices[0].message.content
-                    elif self.ai_provider == 'gemini':
-                        # 修改 Gemini 调用方式
-                        try:
-                            response = self.client.generate_content(
-                                prompt,
-                                generation_config={
-                                    "temperature": 0.7,
-                                    "top_p": 0.8,
-                                    "top_k": 40,
-                                    "max_output_tokens": 1024,
-                                },
-                                safety_settings=[
-                                    {
-                                        "category": "HARM_CATEGORY_HARASSMENT",
-                                        "threshold": "BLOCK_NONE",
-                                    },
-                                    {
-                                        "category": "HARM_CATEGORY_HATE_SPEECH",
-                                        "threshold": "BLOCK_NONE",
-                                    },
-                                    {
-                                        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                                        "threshold": "BLOCK_NONE",
-                                    },
-                                    {
-                                        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                                        "threshold": "BLOCK_NONE",
-                                    },
-                                ]
-                            )
-                            
-                            if response.prompt_feedback.block_reason:
-                                raise Exception(f"Content blocked: {response.prompt_feedback.block_reason}")
-                                
-                            result = response.text
-                            
-                            # 如果返回为空，抛出异常
-                            if not result.strip():
-                                raise Exception("Empty response from Gemini")
-                                
-                        except Exception as e:
-                            logger.error(f"Gemini API error: {str(e)}")
-                            raise
-                    else:
-                        response = self.client.chat.completions.create(
-                            model=self.config.get('openai_model', 'gpt-3.5-turbo'),
-                            messages=[{"role": "user", "content": prompt}]
-                        )
-                        result = response.choices[0].message.content
+                    item = await asyncio.wait_for(self.summary_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                # 每个文档保留完整预算，整批总量超限时本批结束
+                item_tokens = self.count_tokens(item[0])
+                if total_tokens + item_tokens > max_batch_tokens:
+                    carry = item
+                    break
+                batch.append(item)
+                total_tokens += item_tokens
+            
+            # 每批独立执行，并发数由信号量控制
+            task = asyncio.create_task(self.run_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
 
-                    logger.info(f"AI 生成结果: {result}")
+    async def run_batch(self, batch):
+        """执行一批摘要请求，保证所有 future 都有结果"""
+        try:
+            await self.summarize_batch(batch)
+        except asyncio.CancelledError:
+            # 服务关闭时被取消，让调用方走 AI 失败处理
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("服务关闭，摘要任务已取消"))
+            raise
+        except Exception as e:
+            # 兜底：避免调用方一直等待
+            logger.error(f"批量摘要任务执行失败: {str(e)}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def summarize_batch(self, batch):
+        """为一批内容生成摘要和标签，结果通过 future 返回给各个请求"""
+        pending = [(content, future) for content, future in batch if not future.done()]
+        
+        if len(pending) > 1:
+            try:
+                pending = await self.summarize_together(pending)
+            except Exception as e:
+                logger.warning(f"批量摘要失败，改为逐个处理: {str(e)}")
+            if pending:
+                logger.info(f"🔁 {len(pending)} 个文档未能从批量结果中解析，改为逐个处理")
+        
+        # 单个请求以及批量解析失败的文档，逐个使用单文档提示词（各自带重试）
+        await asyncio.gather(
+            *(self.summarize_single(content, future) for content, future in pending)
+        )
 
-                    # 解析摘要和标签
-                    summary = ""
-                    tags = []
-                    
-                    for line in result.split('\n'):
-                        if line.startswith('摘要：'):
-                            summary = line.replace('摘要：', '').strip()
-                        elif line.startswith('标签：'):
-                            tags = [tag.strip() for tag in line.replace('标签：', '').split('，')]
-                    
-                    if not summary or not tags:
-                        raise ValueError("AI 响应格式不正确")
-                    
-                    return summary, tags
+    async def summarize_together(self, pending):
+        """把多个文档合并为一次 AI 调用，返回未能解析出结果的文档"""
+        prompt = BATCH_SUMMARY_PROMPT.format(count=len(pending)) + "".join(
+            f"\n=== 文档{index} ===\n{content}\n"
+            for index, (content, _) in enumerate(pending, 1)
+        )
+        logger.info(f"📦 合并 {len(pending)} 个摘要请求为一次 AI 调用")
+        
+        async with self._ai_semaphore, self._rate_limiter:
+            result = await asyncio.to_thread(
+                self.call_ai, prompt, 1024 * len(pending)
+            )
+        
+        remaining = []
+        for (content, future), parsed in zip(pending, self.parse_batch_result(result, len(pending))):
+            if parsed is None:
+                remaining.append((content, future))
+            elif not future.done():
+                future.set_result(parsed)
+        return remaining
+
+    async def summarize_single(self, content, future):
+        """为单个文档生成摘要和标签，失败时按指数退避重试"""
+        max_retries = self.config.get('openai_max_retries', 3)
+        
+        for attempt in range(max_retries):
+            if future.done():
+                return
+            try:
+                async with self._ai_semaphore, self._rate_limiter:
+                    result = await asyncio.to_thread(
+                        self.call_ai, SUMMARY_PROMPT + content
+                    )
+                parsed = self.parse_summary_tags(result)
+                if not future.done():
+                    future.set_result(parsed)
+                return
 
-                except Exception as e:
-                    if attempt == max_retries - 1:
-                        raise
-                    logger.warning(f"AI 生成失败，尝试重试 ({attempt + 1}/{max_retries}): {str(e)}")
-                    time.sleep(2 ** attempt)  # 指数退避
+            except Exception as e:
+                if attempt == max_retries - 1:
+                    if not future.done():
+                        future.set_exception(e)
+                    return
+                logger.warning(f"AI 生成失败，尝试重试 ({attempt + 1}/{max_retries}): {str(e)}")
+                await asyncio.sleep(2 ** attempt)  # 指数退避
+
+    async def generate_summary_tags(self, content):
+        """使用 AI 生成摘要和标签"""
+        try:
+            # 后台任务未运行时没有人处理队列，直接走失败处理
+            if self.summary_task is None or self.summary_task.done():
+                raise RuntimeError("摘要后台任务未运行")
+            
+            future = asyncio.get_running_loop().create_future()
+            await self.summary_queue.put((self.truncate_content(content), future))
+            try:
+                return await asyncio.wait_for(future, self.config.get('ai_timeout', 300))
+            except asyncio.TimeoutError:
+                raise RuntimeError("AI 摘要生成超时") from None
 
         except Exception as e:
             logger.error(f"AI 服务失败: {str(e)}")
             if self.config.get('notify_on_ai_error', True):
                 try:
-                    asyncio.create_task(self.send_telegram_notification(
+                    await self.send_error_notification(
                         f"⚠️ AI 服务失效提醒\n\n错误信息：{str(e)}"
-                    ))
+                    )
                 except Exception as notify_error:
                     logger.error(f"发送 AI 失效通知失败: {str(notify_error)}")
 
@@ -441,7 +711,7 @@ class WebClipperHandler:
                 )
             raise
 
-    def save_to_notion(self, data):
+    async def save_to_notion(self, data):
         """保存到 Notion 数据库"""
         max_retries = 3
         retry_delay = 2  # 初始延迟2秒
@@ -465,7 +735,7 @@ class WebClipperHandler:
                 }
                 
                 # 设置超时时间
-                response = self.notion_client.pages.create(
+                response = await self.notion_client.pages.create(
                     parent={"database_id": self.config['notion_database_id']},
                     properties=properties
                 )
@@ -481,13 +751,13 @@ class WebClipperHandler:
                     # 使用指数退避策略
                     sleep_time = retry_delay * (2 ** attempt)
                     logger.info(f"等待 {sleep_time} 秒后重试...")
-                    time.sleep(sleep_time)
+                    await asyncio.sleep(sleep_time)
                     continue
                 else:
                     # 所有重试都失败了，发送通知
                     error_msg = f"❌ Notion 保存失败: {str(e)}"
                     try:
-                        asyncio.create_task(self.send_telegram_notification(error_msg))
+                        await self.send_error_notification(error_msg)
                     except Exception as notify_error:
                         logger.error(f"发送 Notion 失败通知失败: {str(notify_error)}")
                     
@@ -499,19 +769,19 @@ class WebClipperHandler:
 
     def get_page_content_by_md(self, md_content):
         """从 markdown 获取标题"""
-        lines = md_content.splitlines()
-        for line in lines:
-            if line.startswith("Title:"):
-                return line.replace("Title:", "").strip()
+        match = TITLE_RE.search(md_content, 0, TITLE_SEARCH_LIMIT)
+        if match:
+            return match.group(1).strip()
         return "未知标题"
 
-    def get_page_content_by_bs(self, url, max_retries=60):
+    async def get_page_content_by_bs(self, url, max_retries=60):
         """从部署的页面获取标题和内容"""
         for attempt in range(max_retries):
             try:
-                response = requests.get(url)
+                response = await self.http_client.get(url)
                 if response.status_code == 200:
-                    soup = BeautifulSoup(response.text, 'html.parser')
+                    # 使用 lxml 解析器，直接传入字节避免编码探测
+                    soup = BeautifulSoup(response.content, 'lxml', from_encoding='utf-8')
                     
                     # 获取标题
                     title = None
@@ -525,18 +795,17 @@ class WebClipperHandler:
                                 title = soup.find(tag).get_text(strip=True)
                                 break
 
-                    # 提取正文内容
-                    html2markdown = html2text.HTML2Text()
-                    html2markdown.ignore_links = True
-                    html2markdown.ignore_images = True
-                    content = html2markdown.handle(soup.prettify())
+                    # 提取正文内容（去掉脚本和样式后一次遍历得到纯文本）
+                    for tag in soup(['script', 'style', 'noscript']):
+                        tag.decompose()
+                    content = soup.get_text(separator='\n', strip=True)
                     
                     return f"Title: {title} \n\n {content}"
                     
-                time.sleep(5)
+                await asyncio.sleep(5)
                 
             except Exception:
-                time.sleep(5)
+                await asyncio.sleep(5)
         
         return os.path.basename(url), ""
 
@@ -547,19 +816,54 @@ class WebClipperHandler:
             text=message
         )
 
+    async def send_error_notification(self, message):
+        """发送错误通知（短时间内的多条错误通知合并为一条发送）"""
+        future = asyncio.get_running_loop().create_future()
+        self._notify_buffer.append((message, future))
+        if self._notify_task is None or self._notify_task.done():
+            self._notify_task = asyncio.create_task(self.flush_notifications())
+        await future
+
+    async def flush_notifications(self):
+        """等待合并窗口结束后发送缓冲区中的错误通知，结果通过 future 返回给调用方"""
+        while self._notify_buffer:
+            await asyncio.sleep(self.config.get('telegram_batch_window', 1))
+            pending, self._notify_buffer = self._notify_buffer, []
+            
+            # 合并消息，超过 Telegram 长度限制时拆分为多条
+            groups = []
+            for message, future in pending:
+                if groups and len(groups[-1][0]) + len(message) + 2 <= TELEGRAM_MAX_MESSAGE_LENGTH:
+                    groups[-1][0] += "\n\n" + message
+                    groups[-1][1].append(future)
+                else:
+                    groups.append([message, [future]])
+            
+            for text, futures in groups:
+                try:
+                    await self.send_telegram_notification(text)
+                except Exception as e:
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for future in futures:
+                        if not future.done():
+                            future.set_result(None)
+
 async def cleanup_old_files():
     """定期清理超过一定时间的临时文件"""
     while True:
         try:
             current_time = time.time()
-            for file_path in UPLOAD_DIR.glob('*'):
-                # 清理超过1小时的文件
-                if current_time - file_path.stat().st_mtime > 3600:
-                    try:
-                        file_path.unlink()
-                        logger.info(f"已清理过期文件: {file_path}")
-                    except Exception as e:
-                        logger.error(f"清理文件失败 {file_path}: {str(e)}")
+            # 索引按写入时间排序，只需从头部检查，遇到未过期的即可停止
+            while PENDING_FILES and current_time - next(iter(PENDING_FILES.values())) > FILE_MAX_AGE:
+                file_path, _ = PENDING_FILES.popitem(last=False)
+                try:
+                    file_path.unlink(missing_ok=True)
+                    logger.info(f"已清理过期文件: {file_path}")
+                except Exception as e:
+                    logger.error(f"清理文件失败 {file_path}: {str(e)}")
         except Exception as e:
             logger.error(f"清理任务执行失败: {str(e)}")
         
@@ -572,17 +876,44 @@ async def lifespan(app: FastAPI):
     handler = WebClipperHandler(CONFIG)
     UPLOAD_DIR.mkdir(exist_ok=True)
     
-    # 启动清理任务
+    # 上次异常退出遗留的文件按修改时间加入索引，交给清理任务处理
+    leftovers = sorted((path.stat().st_mtime, path) for path in UPLOAD_DIR.iterdir())
+    for mtime, path in leftovers:
+        PENDING_FILES[path] = mtime
+    await handler.init_tokenizer()
+    try:
+        await handler.telegram_bot.initialize()
+    except Exception as e:
+        # Telegram 不可用时不影响服务启动，发送通知时再报错
+        logger.warning(f"Telegram Bot 初始化失败: {str(e)}")
+    
+    # 启动清理任务和摘要合并任务
     cleanup_task = asyncio.create_task(cleanup_old_files())
+    handler.summary_task = asyncio.create_task(handler.summary_worker())
     
     yield
     
-    # 关闭时取消清理任务
-    cleanup_task.cancel()
-    try:
-        await cleanup_task
-    except asyncio.CancelledError:
-        pass
+    # 关闭时取消后台任务
+    for task in (cleanup_task, handler.summary_task):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    
+    # 取消仍在执行的批量摘要任务，避免在客户端关闭后继续调用
+    for task in list(handler._batch_tasks):
+        task.cancel()
+    await asyncio.gather(*handler._batch_tasks, return_exceptions=True)
+    
+    # 发送剩余的错误通知
+    if handler._notify_task is not None:
+        await handler._notify_task
+    
+    # 关闭共享的 HTTP 连接池
+    await handler.http_client.aclose()
+    await handler.notion_client.aclose()
+    await handler.telegram_bot.shutdown()
     
     # 清理所有临时文件
     if UPLOAD_DIR.exists():
@@ -604,26 +935,32 @@ async def upload_file(
 ):
     """文件上传接口"""
     try:
+        # 根据 Content-Length 提前拒绝明显超限的请求，无需解析请求体
+        content_length = request.headers.get('content-length', '')
+        if content_length.isdigit() and int(content_length) > MAX_FILE_SIZE + FORM_OVERHEAD:
+            raise HTTPException(
+                status_code=400,
+                detail=f"File too large. Maximum size allowed: {MAX_FILE_SIZE/1024/1024}MB"
+            )
+        
         form = await request.form()
         original_url = form.get('url', '')
         
-        # 获取文件内容
-        file = None
-        for field_name, field_value in form.items():
-            if hasattr(field_value, 'filename') and hasattr(field_value, 'read'):
-                file = field_value
-                break
+        # 按字段名直接获取文件（表单中的普通字段是 str）
+        file = next(
+            (form[name] for name in FILE_FIELD_NAMES if name in form),
+            None
+        )
         
-        if not file:
+        if file is None or isinstance(file, str):
             raise HTTPException(
                 status_code=400,
                 detail="No file content found in form data"
             )
         
+        # 在复制到 UPLOAD_DIR 之前验证文件类型（表单此时已被完整接收，
+        # 真正提前拒绝大请求的只有上面的 Content-Length 检查）
         filename = file.filename
-        content = await file.read()
-        
-        # 验证和保存文件
         file_ext = Path(filename).suffix.lower()
         if not file_ext:
             filename += '.html'
@@ -633,25 +970,32 @@ async def upload_file(
                 detail=f"File type not allowed. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
             )
         
-        if len(content) > MAX_FILE_SIZE:
-            raise HTTPException(
-                status_code=400,
-                detail=f"File too large. Maximum size allowed: {MAX_FILE_SIZE/1024/1024}MB"
-            )
-        
-        # 保存文件
+        # 分块写入文件，避免整个文件驻留内存
         safe_filename = f"{secrets.token_hex(8)}_{filename}"
         file_path = UPLOAD_DIR / safe_filename
         
-        with open(file_path, "wb") as f:
-            f.write(content)
+        total_size = 0
+        try:
+            async with aiofiles.open(file_path, "wb") as f:
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    total_size += len(chunk)
+                    if total_size > MAX_FILE_SIZE:
+                        raise HTTPException(
+                            status_code=400,
+                            detail=f"File too large. Maximum size allowed: {MAX_FILE_SIZE/1024/1024}MB"
+                        )
+                    await f.write(chunk)
+        except Exception:
+            file_path.unlink(missing_ok=True)
+            raise
+        PENDING_FILES[file_path] = time.time()
         
         try:
             result = await handler.process_file(file_path, original_url)
             return result
         finally:
-            if file_path.exists():
-                file_path.unlink()  # 这里会删除单个处理完的文件
+            PENDING_FILES.pop(file_path, None)
+            file_path.unlink(missing_ok=True)  # 这里会删除单个处理完的文件
                 
     except HTTPException:
         raise